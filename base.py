@@ -10,6 +10,7 @@ mission_product_dict = {
         'base_url': 'https://gpm1.gesdisc.eosdis.nasa.gov:443',
         'process_level': 'GPM_L3',
         'version': 6,
+        'frequency': '30min',
         'products': {
             '3IMERGHHE': '{mission}_{product}.{version:02}/{year}/{dayofyear:03}/3B-HHR-E.MS.MRG.3IMERG.{'
                          'date}-S{time_start}-E{time_end}.{minutes}.V{version:02}B.HDF5',
@@ -27,3 +28,6 @@ master_datasets = {'3IMERGHHE': ['precipitationQualityIndex', 'IRkalmanFilterWei
                                  'HQprecipitation', 'probabilityLiquidPrecipitation', 'randomError', 'IRprecipitation'],
                    '3IMERGHH': ['precipitationQualityIndex', 'IRkalmanFilterWeight', 'precipitationCal',
                                 'HQprecipitation', 'probabilityLiquidPrecipitation', 'randomError', 'IRprecipitation']}
+
+scale_factors = {'precipitationQualityIndex': 0.01, 'precipitationCal': 0.01, 'precipitationUncal': 0.01,
+                 'HQprecipitation': 0.01, 'randomError': 0.01, 'IRprecipitation': 0.01}
@@ -5,17 +5,217 @@ Created on Wed Jul 22 22:27:09 2020
 This file is based on https://github.com/mullenkamp/nasadap
 """
 import os
+import re
+import hashlib
+import warnings
+import asyncio
+import multiprocessing
 import pandas as pd
 import numpy as np
 import xarray as xr
+import dask.array
 import requests
-from time import sleep
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+from aiohttp_client_cache import CachedSession, SQLiteBackend
+from io import BytesIO
+from http.cookiejar import MozillaCookieJar, LoadError
 from lxml import etree
-import itertools
-from multiprocessing.pool import ThreadPool
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pydap.cas.urs import setup_session
-from pydap.client import open_url
-from base import mission_product_dict, master_datasets
+from base import mission_product_dict, master_datasets, scale_factors
+
+try:
+    import fsspec
+    import h5py
+except ImportError:
+    h5py = None
+
+
+# Start time in the name of the files
+_granule_start = re.compile(r'\.(\d{8}-S\d{6})-E')
+
+# Session of the download worker processes, set up by _init_worker
+_session = None
+
+
+def _init_worker(session):
+    global _session
+    _session = session
+
+
+def _run(coroutine):
+    # asyncio.run can't be called while an event loop is running, as in Jupyter, so the coroutine then runs in its
+    # own thread
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+
+def _check_response(response, url):
+    response.raise_for_status()
+    # Without a valid session the server answers with the Earthdata login page instead of the file
+    if 'urs.earthdata.nasa.gov' in response.url:
+        raise ValueError('The Earthdata session is not valid to access ' + url)
+
+
+def _h5_attrs(h5_object):
+    # Attributes of a HDF5 object as netCDF would read them, without the dimension scales bookkeeping
+    attrs = {}
+    for key, value in h5_object.attrs.items():
+        if key in ('CLASS', 'NAME', 'DIMENSION_LIST', 'REFERENCE_LIST', '_Netcdf4Dimid'):
+            continue
+        if getattr(value, 'size', None) == 1:
+            value = value.item()
+        if isinstance(value, bytes):
+            value = value.decode()
+        attrs[key] = value
+    return attrs
+
+
+def _read_granule(session, url, subset, with_coords):
+
+    # The HDF5 file is read straight from the data archive, requesting only the chunks covering the area with
+    # byte-range GETs, and the chunk cache is sized to hold them. The archive keeps the files at the same path after
+    # the process level as the opendap server, whatever the server's prefix is
+    url = '/'.join([subset['data_url'], url.split('/{}/'.format(subset['process_level']), 1)[1]])
+    lon, lat = subset['lon'], subset['lat']
+    cache_size = max(2 ** 20, 4 * (lon.stop - lon.start) * (lat.stop - lat.start))
+
+    print(url)
+    _check_response(session.head(url, allow_redirects=True), url)
+    fs = fsspec.filesystem('https', client_kwargs={'cookies': session.cookies.get_dict()})
+    with fs.open(url) as file, h5py.File(file, 'r', rdcc_nbytes=cache_size) as h5:
+        grid = h5['Grid']
+        data_vars = {v: (('time', 'lon', 'lat'), grid[v][0:1, lon, lat], _h5_attrs(grid[v]))
+                     for v in subset['datasets']}
+        coords = {'time': ('time', grid['time'][:], _h5_attrs(grid['time']))}
+        if with_coords:
+            coords['lon'] = ('lon', grid['lon'][lon], _h5_attrs(grid['lon']))
+            coords['lat'] = ('lat', grid['lat'][lat], _h5_attrs(grid['lat']))
+    # The fill values are masked and the variables scaled, as open_dataset does, while time stays as the seconds in
+    # the file
+    return xr.decode_cf(xr.Dataset(data_vars, coords=coords), decode_times=False)
+
+
+def _quantize(ds):
+    # The float variables are stored as uint16 with their scale factor, within the precision IMERG states. They are
+    # never negative, and the largest uint16 is left for the fill value, so the few values above the range are clipped
+    fill_value = np.iinfo(np.uint16).max
+    for v in ds.data_vars:
+        if v in scale_factors:
+            largest = (fill_value - 1) * scale_factors[v]
+            if (ds[v] > largest).any():
+                warnings.warn('{} values above {} are clipped to it'.format(v, largest))
+            ds[v] = ds[v].clip(0, largest)
+            ds[v].encoding = {'dtype': 'uint16', 'scale_factor': scale_factors[v], 'add_offset': 0.0,
+                              '_FillValue': fill_value}
+    return ds
+
+
+def _get_granule(session, url, subset, with_coords=False):
+
+    # The file is subset by the opendap server, unless its HDF5 chunks are requested to be read instead
+    if subset['hdf5']:
+        ds = _read_granule(session, url, subset, with_coords)
+    else:
+        # Update url, requesting every variable as netCDF-4 in a single response
+        url += '.nc4?' + subset['ce']
+        if with_coords:
+            url += subset['coords_ce']
+
+        print(url)
+        response = session.get(url, stream=True)
+        _check_response(response, url)
+        # The store is written with the encoding of the decoded variables, so only time is left as the seconds in the
+        # file
+        ds = xr.open_dataset(BytesIO(response.content), engine='h5netcdf', decode_times=False).load()
+
+    return _quantize(ds)
+
+
+def _create_store(store_path, ds, times):
+    # Every variable is pre-allocated along the whole time axis with one chunk per file, so each file is written to its
+    # own region without touching the others. The variables keep the encoding of the files, which the writes of every
+    # region are encoded with
+    data_vars = {}
+    for v in ds.data_vars:
+        data = dask.array.zeros((len(times),) + ds[v].shape[1:], dtype=ds[v].dtype, chunks=(1,) + ds[v].shape[1:])
+        # The _FillValue is also the fill value of the zarr array, so the regions not written yet read as missing
+        encoding = {key: value for key, value in ds[v].encoding.items()
+                    if key in ('dtype', 'scale_factor', 'add_offset', '_FillValue')}
+        data_vars[v] = xr.Variable(ds[v].dims, data, ds[v].attrs, encoding=encoding)
+    # Flag of the files already written, which reads as missing until _write_granule sets it
+    data_vars['written'] = xr.Variable('time', dask.array.zeros(len(times), dtype='uint8', chunks=1),
+                                       encoding={'_FillValue': 0})
+    # IMERG times are seconds since 1970-01-01, which the time units are encoded with
+    attrs = {key: value for key, value in ds['time'].attrs.items() if key not in ('units', 'calendar')}
+    time = xr.Variable('time', times.values, attrs, encoding={'units': 'seconds since 1970-01-01', 'dtype': 'int64'})
+    coords = {'time': time, 'lon': ds['lon'], 'lat': ds['lat']}
+    xr.Dataset(data_vars, coords=coords, attrs=ds.attrs).to_zarr(store_path, compute=False)
+
+
+def _write_granule(ds, store_path, index):
+    # time, lat and lon are written with the store, so only the data variables go to the file's region, and the
+    # processes writing at the same time never share a chunk. The file is flagged as written once its data is
+    region = {'time': slice(index, index + 1)}
+    ds.drop_vars(['time', 'lat', 'lon'], errors='ignore').to_zarr(store_path, region=region)
+    xr.Dataset({'written': ('time', np.ones(1, dtype='uint8'))}).to_zarr(store_path, region=region)
+
+
+def _written(store_path, indexes):
+    # Whether the files at the indexes are already written to the store, reading only their flags
+    if not os.path.exists(store_path):
+        return np.zeros(len(indexes), dtype=bool)
+    return xr.open_zarr(store_path)['written'][indexes].notnull().values
+
+
+def _download_worker(url, subset, store_path, index):
+    _write_granule(_get_granule(_session, url, subset), store_path, index)
+
+
+def _grid_indexes(min_lat, max_lat, min_lon, max_lon):
+    # Indexes of the coordinates in the 0.1 degree grid, whose first cells are centred at -179.95 and -89.95, or its
+    # bounds when the coordinate isn't given
+    min_lon = 0 if min_lon is None else max(0, min(3599, int(round((min_lon + 179.95) / 0.1))))
+    max_lon = 3599 if max_lon is None else max(0, min(3599, int(round((max_lon + 179.95) / 0.1))))
+    min_lat = 0 if min_lat is None else max(0, min(1799, int(round((min_lat + 89.95) / 0.1))))
+    max_lat = 1799 if max_lat is None else max(0, min(1799, int(round((max_lat + 89.95) / 0.1))))
+
+    if min_lon >= max_lon:
+        raise ValueError('min_lon must be smaller than max_lon')
+    if min_lat >= max_lat:
+        raise ValueError('min_lat must be smaller than max_lat')
+    return min_lat, max_lat, min_lon, max_lon
+
+
+def _catalog_days(content):
+    # Days of the year listed as directories in a year catalog
+    days = set()
+    for _, element in etree.iterparse(BytesIO(content), tag='{*}catalogRef'):
+        if element.get('name', '').isdigit():
+            days.add(int(element.get('name')))
+        element.clear()
+    return days
+
+
+def _catalog_urls(content, base_url):
+    # The files are the datasets nested in the directory dataset of a day catalog
+    urls = []
+    for _, element in etree.iterparse(BytesIO(content), tag='{*}dataset'):
+        if element.getparent().tag == element.tag and '.xml' not in element.get('ID', '.xml'):
+            urls.append(base_url + element.get('ID'))
+        element.clear()
+    return urls
+
+
+def _day_complete(urls, frequency):
+    # Whether a day catalog already lists all the files of the day
+    return len(urls) >= pd.Timedelta('1D') // pd.Timedelta(frequency)
 
 
 class Nasa:
@@ -31,7 +231,8 @@ class Nasa:
     mission : str
         Mission name.
     cache_dir : str or None
-        A path to cache the netcdf files for future reading. If None, the currently working directory is used.
+        A path to keep the zarr stores of the downloaded data, one per year, area and datasets, along with the
+        catalogs and login cookies, for future reading. If None, the currently working directory is used.
 
     Returns
     -------
@@ -56,7 +257,8 @@ class Nasa:
         version: int, optional
             Data product version.
         cache_dir : str or None
-            A path to cache the netcdf files for future reading. If None, the currently working directory is used.
+            A path to keep the zarr stores of the downloaded data, one per year, area and datasets, along with the
+            catalogs and login cookies, for future reading. If None, the currently working directory is used.
 
         Returns
         -------
@@ -87,85 +289,112 @@ class Nasa:
         else:
             self.cache_dir = os.getcwd()
 
-        # Setting up a pydap session
-        self.session = setup_session(username, password, check_url='/'.join(
-            [self.mission_dict['base_url'], 'opendap', self.mission_dict['process_level']]))
+        # Files' urls of each (year, dayofyear) already listed from the catalogs, only for the days with all their
+        # files published
+        self.catalog_cache = {}
+
+        # lat and lon of each (min_lat, max_lat, min_lon, max_lon) indexes already downloaded
+        self.coord_cache = {}
+
+        # Setting up a pydap session, reusing the Earthdata cookies of a previous session while they are valid
+        check_url = '/'.join([self.mission_dict['base_url'], 'opendap', self.mission_dict['process_level']])
+        cookies_path = os.path.join(self.cache_dir, 'earthdata_cookies.txt')
+        self.session = None
+        if os.path.isfile(cookies_path):
+            cookie_jar = MozillaCookieJar(cookies_path)
+            try:
+                cookie_jar.load(ignore_discard=True, ignore_expires=True)
+            except LoadError:
+                # A corrupt cookie file is replaced by a new login
+                cookie_jar = None
+            if cookie_jar is not None:
+                session = requests.Session()
+                session.cookies.update(cookie_jar)
+                # As in pydap's session, the credentials let requests log in again once the cookies expire
+                session.auth = (username, password)
+                response = session.head(check_url, allow_redirects=True)
+                if response.ok and 'urs.earthdata.nasa.gov' not in response.url:
+                    self.session = session
+
+        if self.session is None:
+            self.session = setup_session(username, password, check_url=check_url)
+            cookie_jar = MozillaCookieJar(cookies_path)
+            for cookie in self.session.cookies:
+                cookie_jar.set_cookie(cookie)
+            # The cookies give access to the Earthdata account, so only the owner can read them
+            os.close(os.open(cookies_path, os.O_WRONLY | os.O_CREAT, 0o600))
+            os.chmod(cookies_path, 0o600)
+            cookie_jar.save(ignore_discard=True, ignore_expires=True)
 
-    def __get_files_urls(self, date, file_path, base_url):
+        # Retrying the transient server errors with exponential backoff
+        retry = Retry(total=5, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                      respect_retry_after_header=True)
+        self.session.mount('https://', HTTPAdapter(max_retries=retry))
+
+    async def __get_catalog(self, session, url):
+        async with session.get(url) as response:
+            response.raise_for_status()
+            # Without a valid session the server answers with the Earthdata login page instead of the catalog
+            if 'urs.earthdata.nasa.gov' in str(response.url):
+                await session.cache.delete_url(url)
+                raise ValueError('The Earthdata session is not valid to access ' + url)
+            return await response.read()
+
+    async def __get_year_days(self, session, year, requested_days, file_path, base_url):
+        path = os.path.split(file_path)[0].format(mission=self.mission.upper(), product=self.product, year=year,
+                                                  version=self.version)
+        path = '/'.join([self.mission_dict['process_level'], path])
+        url = '/'.join([base_url, 'opendap', path, 'catalog.xml'])
+        days = _catalog_days(await self.__get_catalog(session, url))
+        # The catalog of a year still being published is requested again next time, instead of read from the http
+        # cache, so the days published meanwhile aren't missed
+        if year == pd.Timestamp.utcnow().year or not requested_days <= days:
+            await session.cache.delete_url(url)
+        return year, days
+
+    async def __get_files_urls(self, session, date, file_path, base_url):
         path = file_path.format(mission=self.mission.upper(), product=self.product, year=date.year,
                                 dayofyear=date.dayofyear, version=self.version)
         path = '/'.join([self.mission_dict['process_level'], path])
         url = '/'.join([base_url, 'opendap', path, 'catalog.xml'])
-        response = requests.get(url)
-        et = etree.fromstring(response.content)
-        urls = [base_url + c.attrib['ID'] for c in et.getchildren()[3].getchildren() if '.xml' not in c.attrib['ID']]
-        return urls
-
-    def __download_files(self, url, path, datasets, min_lat, max_lat, min_lon, max_lon):
-
-        # Setting up coordinates
-        range_lon = np.round(np.arange(-179.95, 180, 0.1), 2)
-        range_lat = np.round(np.arange(-89.95, 90, 0.1), 2)
-        min_lon = (np.abs(range_lon - min_lon)).argmin()
-        max_lon = (np.abs(range_lon - max_lon)).argmin()
-        min_lat = (np.abs(range_lat - min_lat)).argmin()
-        max_lat = (np.abs(range_lat - max_lat)).argmin()
-
-        if min_lon >= max_lon:
-            raise ValueError('min_lon must be smaller than max_lon')
-        if min_lat >= max_lat:
-            raise ValueError('min_lat must be smaller than max_lat')
+        urls = _catalog_urls(await self.__get_catalog(session, url), base_url)
+        # A day still being published is requested again next time, instead of read from the http cache
+        if not _day_complete(urls, self.mission_dict['frequency']):
+            await session.cache.delete_url(url)
+        return date, urls
 
-        coordinates = '[0:1:0][{min_lon}:1:{max_lon}][{min_lat}:1:{max_lat}]'.format(min_lon=min_lon, max_lon=max_lon,
-                                                                                     min_lat=min_lat, max_lat=max_lat)
+    async def __gather_files_urls(self, dates, file_path, base_url, callback, dl_sim_count):
+        # A single session keeps the TLS connections alive across all the catalog requests, while the catalogs
+        # already requested in the last day are read from the local http cache
+        cache = SQLiteBackend(cache_name=os.path.join(self.cache_dir, 'http_cache.sqlite'), expire_after=86400,
+                              allowed_codes=(200,))
+        connector = aiohttp.TCPConnector(limit=dl_sim_count, limit_per_host=dl_sim_count)
+        async with CachedSession(cache=cache, connector=connector, cookies=self.session.cookies.get_dict()) as session:
+            # The urls of the days already in the catalog cache are handed to the callback right away
+            for date in dates:
+                if (date.year, date.dayofyear) in self.catalog_cache:
+                    callback(self.catalog_cache[(date.year, date.dayofyear)])
 
-        #Update url
-        url += '?'
-        if 'precipitationQualityIndex' in datasets:
-            url += 'precipitationQualityIndex'+coordinates + ','
-        if 'IRkalmanFilterWeight' in datasets:
-            url += 'IRkalmanFilterWeight' + coordinates + ','
-        if 'HQprecipSource' in datasets:
-            url += 'HQprecipSource' + coordinates + ','
-        if 'precipitationCal' in datasets:
-            url += 'precipitationCal' + coordinates + ','
-        if 'precipitationUncal' in datasets:
-            url += 'precipitationUncal' + coordinates + ','
-        if 'HQprecipitation' in datasets:
-            url += 'HQprecipitation' + coordinates + ','
-        if 'probabilityLiquidPrecipitation' in datasets:
-            url += 'probabilityLiquidPrecipitation' + coordinates + ','
-        if 'HQobservationTime' in datasets:
-            url += 'HQobservationTime' + coordinates + ','
-        if 'randomError' in datasets:
-            url += 'randomError' + coordinates + ','
-        if 'IRprecipitation' in datasets:
-            url += 'IRprecipitation' + coordinates + ','
-
-        url += 'lat[{min_lat}:1:{max_lat}],'.format(min_lat=min_lat, max_lat=max_lat)
-        url += 'lon[{min_lon}:1:{max_lon}],'.format(min_lon=min_lon, max_lon=max_lon)
-        url += 'time[0:1:0]'
-
-        print(path)
-        counter = 5
-        while counter > 0:
-            try:
-                pydap_ds = open_url(url, session=self.session)
-                store = xr.backends.PydapDataStore(pydap_ds)
-                ds = xr.open_dataset(store)
-                if not os.path.isfile(path):
-                    ds.to_netcdf(path)
-                counter = 0
-                return ds
-            except Exception as err:
-                print(err)
-                print('Retrying in 3 seconds...')
-                counter = counter - 1
-                sleep(3)
-
-    def get_data(self, from_date, to_date, min_lat=None, max_lat=None, min_lon=None, max_lon=None):
+            # Only the days missing from the catalog cache that the year catalogs list are requested, and their urls
+            # are handed to the callback as soon as each catalog arrives
+            dates = [date for date in dates if (date.year, date.dayofyear) not in self.catalog_cache]
+            years = dict(await asyncio.gather(*[
+                self.__get_year_days(session, year, {date.dayofyear for date in dates if date.year == year}, file_path,
+                                     base_url)
+                for year in set(date.year for date in dates)]))
+            dates = [date for date in dates if date.dayofyear in years[date.year]]
+            for task in asyncio.as_completed([self.__get_files_urls(session, date, file_path, base_url)
+                                              for date in dates]):
+                date, urls = await task
+                if _day_complete(urls, self.mission_dict['frequency']):
+                    self.catalog_cache[(date.year, date.dayofyear)] = urls
+                callback(urls)
+
+    def get_data(self, dataset_types, from_date, to_date, min_lat=None, max_lat=None, min_lon=None, max_lon=None,
+                 dl_sim_count=8, read_hdf5=False):
         """
-        Function to download trmm or gpm data and convert it to an xarray dataset.
+        Function to download trmm or gpm data and convert it to an xarray dataset. The files are downloaded in
+        spawned processes, so a script calling it must do so under if __name__ == '__main__'.
 
         Parameters
         ----------
@@ -183,6 +412,12 @@ class Nasa:
             The minimum lon to extract in WGS84 decimal degrees.
         max_lon : int, float, or None
             The maximum lon to extract in WGS84 decimal degrees.
+        dl_sim_count : int, optional
+            The maximum number of simultaneous connections to the server, both for the catalogs and the files, to stay
+            under its connection limits. The downloads wait on the network, so it isn't bounded by the number of CPUs.
+        read_hdf5 : bool, optional
+            Read only the chunks of the area straight from the HDF5 files in the data archive, instead of having the
+            opendap server subset them. It requires h5py and fsspec, and the requests aren't retried on server errors.
 
         Returns
         -------
@@ -199,42 +434,107 @@ class Nasa:
 
         base_url = self.mission_dict['base_url']
 
-        # Getting files' url:
-        if 'dayofyear' in file_path:
+        # Setting up the coordinates as indexes of the 0.1 degree grid, once for all the files
+        min_lat, max_lat, min_lon, max_lon = _grid_indexes(min_lat, max_lat, min_lon, max_lon)
+
+        if read_hdf5 and h5py is None:
+            raise ValueError('read_hdf5 requires h5py and fsspec to be installed')
+
+        # Verifying the dataset types
+        if isinstance(dataset_types, str):
+            dataset_types = [dataset_types]
+        for dataset in dataset_types:
+            if dataset not in master_datasets[self.product]:
+                raise ValueError('Dataset types must be one of: ' + ', '.join(master_datasets[self.product]))
+
+        # Setting up the constraint expression, shared by all the files. lat and lon are the same for every file, so
+        # they are only requested while they are not known yet
+        coordinates = '[0:1:0][{min_lon}:1:{max_lon}][{min_lat}:1:{max_lat}]'.format(min_lon=min_lon, max_lon=max_lon,
+                                                                                     min_lat=min_lat, max_lat=max_lat)
+        ce = ','.join(dataset + coordinates for dataset in dataset_types) + ',time[0:1:0]'
+        coords_ce = ',lat[{min_lat}:1:{max_lat}],lon[{min_lon}:1:{max_lon}]'.format(min_lat=min_lat, max_lat=max_lat,
+                                                                                    min_lon=min_lon, max_lon=max_lon)
+        coords_key = (min_lat, max_lat, min_lon, max_lon)
+
+        # Everything needed to subset a file, either by the opendap server or by reading its HDF5 chunks
+        subset = {'ce': ce, 'coords_ce': coords_ce, 'datasets': dataset_types, 'lon': slice(min_lon, max_lon + 1),
+                  'lat': slice(min_lat, max_lat + 1), 'hdf5': read_hdf5,
+                  'data_url': '/'.join([base_url, 'data', self.mission_dict['process_level']]),
+                  'process_level': self.mission_dict['process_level']}
+
+        # The files are written to a zarr store per year, named after the year and the constraint expression, so that
+        # any later request of the same area and datasets reuses the files already written
+        frequency = pd.Timedelta(self.mission_dict['frequency'])
+        stores = {}
+        for year in sorted(set(dates.year)):
+            store_name = '{mission}_{product}.{version:02}_{year}_{ce}.zarr'.format(
+                mission=self.mission.upper(), product=self.product, version=self.version, year=year,
+                ce=hashlib.md5(ce.encode()).hexdigest()[:8])
+            store_path = os.path.join(self.cache_dir, store_name)
+
+            # Time axis of the whole year, where each file is placed from the start time in its name
+            times = pd.date_range(pd.Timestamp(year=year, month=1, day=1), pd.Timestamp(year=year + 1, month=1, day=1),
+                                  freq=frequency)[:-1]
+
+            # Only the requested files not written yet are downloaded
+            indexes = np.flatnonzero((times >= dates[0]) & (times < dates[-1] + pd.Timedelta('1D')))
+            written = np.zeros(len(times), dtype=bool)
+            written[indexes] = _written(store_path, indexes)
+            stores[year] = {'path': store_path, 'times': times, 'written': written, 'created': None}
+
+        futures = []
+
+        def create_store(url, store, index):
+            # The store is created from its first file
+            if coords_key in self.coord_cache:
+                ds = _get_granule(self.session, url, subset).assign_coords(**self.coord_cache[coords_key])
+            else:
+                ds = _get_granule(self.session, url, subset, with_coords=True)
+                self.coord_cache[coords_key] = {'lat': ds['lat'], 'lon': ds['lon']}
+            _create_store(store['path'], ds, store['times'])
+            _write_granule(ds, store['path'], index)
+
+        async def write(url, store, index):
+            # The other files of a store being created wait for it before going to the download processes
+            if store['created'] is not None:
+                await store['created']
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(executor, _download_worker, url, subset, store['path'], index)
+
+        def download(urls):
+            # Each file is sent to the download processes as soon as its url is known, and a missing store is created
+            # in a thread, so the catalogs keep being requested meanwhile
+            for url in urls:
+                start = pd.to_datetime(_granule_start.search(url).group(1), format='%Y%m%d-S%H%M%S')
+                store = stores[start.year]
+                index = (start - store['times'][0]) // frequency
+                if store['written'][index]:
+                    continue
+                if store['created'] is None and not os.path.exists(store['path']):
+                    store['created'] = asyncio.get_running_loop().run_in_executor(None, create_store, url, store, index)
+                    futures.append(store['created'])
+                else:
+                    futures.append(asyncio.ensure_future(write(url, store, index)))
+
+        async def download_all():
+            await self.__gather_files_urls(dates, file_path, base_url, download, dl_sim_count)
+            await asyncio.gather(*futures)
+
+        # Getting files' url and downloading the data, decoding and writing each file in its own process. The processes
+        # are spawned, since forking them from the threads of the event loop and of the stores creation may deadlock
+        print('Downloading the data...')
+        with ProcessPoolExecutor(max_workers=dl_sim_count, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker, initargs=(self.session,)) as executor:
             print("Getting the files' url from NASA server...")
             file_path = os.path.split(file_path)[0]
-            iteration = [(date, file_path, base_url) for date in dates]
-            url_list = list(itertools.chain.from_iterable(ThreadPool(30).starmap(self.__get_files_urls, iteration)))
-
-        elif 'month' in file_path:
-            print('Generating urls...')
-            url_list = ['/'.join([base_url, 'opendap', self.mission_dict['process_level'],
-                        file_path.format(mission=self.mission.upper(), product=self.product, year=d.year, month=d.month,
-                                         date=d.strftime('%Y%m%d'), version=self.version)]) for d in dates]
-        return url_list
-        # Setting up local urls
-        # if 'hyrax' in url_list[0]:
-        #     split_text = 'hyrax/'
-        # else:
-        #     split_text = 'opendap/'
-        #
-        # url_dict = {url: os.path.join(self.cache_dir, os.path.splitext(url.split(split_text)[1])[0] + '.nc4') for url in
-        #             url_list}
-        #
-        # save_dirs = set([os.path.split(url)[0] for url in url_dict.values()])
-        #
-        # for path in save_dirs:
-        #     if not os.path.exists(path):
-        #         os.makedirs(path)
-        #
-        # # Downloading the data
-        # iteration = [(url, path, min_lat, max_lat, min_lon, max_lon) for url, path in url_dict.items()]
-        #
-        # print('Downloading the data...')
-        # output = ThreadPool(30).starmap(self.__download_files, iteration)
-        # return output
-        # ds_list = []
-        # ds_list.extend(output)
-        # print('Converting the data...')
-        # ds_all = xr.concat(ds_list, dim='time').sortby('time')
-        # return ds_all
+            _run(download_all())
+
+        # The stores already hold the files in time order, so reading them decodes the fill values and times at once,
+        # and only the requested days are kept
+        print('Converting the data...')
+        paths = [store['path'] for store in stores.values() if os.path.exists(store['path'])]
+        if not paths:
+            raise ValueError('No files were found from {} to {}'.format(dates[0].date(), dates[-1].date()))
+        ds_all = xr.concat([xr.open_zarr(path) for path in paths], dim='time')
+        ds_all = ds_all.sel(time=slice(dates[0], dates[-1] + pd.Timedelta('1D') - frequency)).drop_vars('written')
+        return ds_all
@@ -0,0 +1,118 @@
+import numpy as np
+import pytest
+import pandas as pd
+import xarray as xr
+from get_data import _catalog_days, _catalog_urls, _create_store, _day_complete, _grid_indexes, _quantize, \
+    _write_granule, _written
+
+BASE_URL = 'https://gpm1.gesdisc.eosdis.nasa.gov:443'
+
+YEAR_CATALOG = b'''<?xml version="1.0" encoding="UTF-8"?>
+<thredds:catalog xmlns:thredds="http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0"
+                 xmlns:xlink="http://www.w3.org/1999/xlink" name="Hyrax: THREDDS Catalog">
+  <thredds:service name="dap" serviceType="OPeNDAP" base="/opendap/"/>
+  <thredds:dataset name="/GPM_L3/GPM_3IMERGHH.06/2020" ID="/opendap/GPM_L3/GPM_3IMERGHH.06/2020/">
+    <thredds:catalogRef name="001" xlink:href="001/catalog.xml" xlink:title="001" xlink:type="simple"/>
+    <thredds:catalogRef name="002" xlink:href="002/catalog.xml" xlink:title="002" xlink:type="simple"/>
+    <thredds:catalogRef name="doc" xlink:href="doc/catalog.xml" xlink:title="doc" xlink:type="simple"/>
+  </thredds:dataset>
+</thredds:catalog>
+'''
+
+DAY_PATH = '/opendap/GPM_L3/GPM_3IMERGHH.06/2020/001/'
+
+DAY_CATALOG = '''<?xml version="1.0" encoding="UTF-8"?>
+<thredds:catalog xmlns:thredds="http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0"
+                 name="Hyrax: THREDDS Catalog">
+  <thredds:service name="dap" serviceType="OPeNDAP" base="/opendap/"/>
+  <thredds:dataset name="/GPM_L3/GPM_3IMERGHH.06/2020/001" ID="{path}">
+    <thredds:dataset name="{first}" ID="{path}{first}">
+      <thredds:dataSize units="bytes">9457263</thredds:dataSize>
+    </thredds:dataset>
+    <thredds:dataset name="{first}.xml" ID="{path}{first}.xml">
+      <thredds:dataSize units="bytes">5362</thredds:dataSize>
+    </thredds:dataset>
+    <thredds:dataset name="{second}" ID="{path}{second}">
+      <thredds:dataSize units="bytes">9457201</thredds:dataSize>
+    </thredds:dataset>
+  </thredds:dataset>
+</thredds:catalog>
+'''.format(path=DAY_PATH, first='3B-HHR.MS.MRG.3IMERG.20200101-S000000-E002959.0000.V06B.HDF5',
+           second='3B-HHR.MS.MRG.3IMERG.20200101-S003000-E005959.0030.V06B.HDF5').encode()
+
+
+def _granule(start, value):
+    # A file as _get_granule returns it, already decoded, with time as the seconds in the file
+    seconds = (pd.Timestamp(start) - pd.Timestamp('1970-01-01')) // pd.Timedelta('1s')
+    data = np.full((1, 3, 2), value, dtype='float32')
+    data[0, 0, 0] = np.nan
+    ds = xr.Dataset({'precipitationCal': (('time', 'lon', 'lat'), data, {'units': 'mm/hr'})},
+                    coords={'time': ('time', [seconds], {'units': 'seconds since 1970-01-01 00:00:00 UTC'}),
+                            'lon': ('lon', [-179.95, -179.85, -179.75]), 'lat': ('lat', [-89.95, -89.85])})
+    return _quantize(ds)
+
+
+def test_grid_indexes():
+    assert _grid_indexes(None, None, None, None) == (0, 1799, 0, 3599)
+    assert _grid_indexes(-89.95, 89.95, -179.95, 179.95) == (0, 1799, 0, 3599)
+    # Each coordinate falls in the cell of its index, centred at -89.95 + 0.1 * index and -179.95 + 0.1 * index
+    assert _grid_indexes(-10.02, -4.98, -60.04, -49.96) == (799, 850, 1199, 1300)
+    # The coordinates beyond the grid are clipped to its bounds
+    assert _grid_indexes(-95, 95, -185, 185) == (0, 1799, 0, 3599)
+    with pytest.raises(ValueError, match='min_lat'):
+        _grid_indexes(10, 10, None, None)
+    with pytest.raises(ValueError, match='min_lon'):
+        _grid_indexes(None, None, 20, 10)
+
+
+def test_catalog_days():
+    assert _catalog_days(YEAR_CATALOG) == {1, 2}
+
+
+def test_catalog_urls():
+    path = BASE_URL + DAY_PATH + '3B-HHR.MS.MRG.3IMERG.20200101-'
+    assert _catalog_urls(DAY_CATALOG, BASE_URL) == [path + 'S000000-E002959.0000.V06B.HDF5',
+                                                    path + 'S003000-E005959.0030.V06B.HDF5']
+
+
+def test_day_complete():
+    assert not _day_complete(_catalog_urls(DAY_CATALOG, BASE_URL), '30min')
+    assert _day_complete(['url'] * 48, '30min')
+    assert _day_complete(['url'], '1D')
+
+
+def test_store_regions(tmp_path):
+    store_path = str(tmp_path / 'store.zarr')
+    times = pd.date_range('2020-01-01', periods=4, freq='30min')
+
+    # The store is created from its first file, and the files are written to their own regions
+    first = _granule(times[1], 1.234)
+    with pytest.warns(UserWarning, match='clipped'):
+        second = _granule(times[3], 700.0)
+    _create_store(store_path, first, times)
+    _write_granule(first, store_path, 1)
+    _write_granule(second, store_path, 3)
+
+    ds = xr.open_zarr(store_path)
+    np.testing.assert_array_equal(ds['time'].values, times.values)
+    np.testing.assert_array_equal(ds['lon'].values, first['lon'].values)
+    values = ds['precipitationCal'].values
+    assert np.isnan(values[[0, 2]]).all()
+    assert np.isnan(values[[1, 3], 0, 0]).all()
+    np.testing.assert_allclose(values[1, 1:], 1.23, atol=1e-5)
+    np.testing.assert_allclose(values[3, 1:], 655.34, atol=1e-3)
+    assert ds['precipitationCal'].attrs == {'units': 'mm/hr'}
+
+
+def test_written(tmp_path):
+    store_path = str(tmp_path / 'store.zarr')
+    times = pd.date_range('2020-01-01', periods=4, freq='30min')
+    assert not _written(store_path, [0, 1]).any()
+
+    # A file whose area is all missing is still flagged as written
+    first = _granule(times[0], 1.0)
+    _create_store(store_path, first, times)
+    _write_granule(first, store_path, 0)
+    _write_granule(_granule(times[2], np.nan), store_path, 2)
+    np.testing.assert_array_equal(_written(store_path, [0, 1, 2, 3]), [True, False, True, False])
+    np.testing.assert_array_equal(_written(store_path, [2]), [True])